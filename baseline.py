@@ -1,13 +1,11 @@
 import argparse
 import torch
-import numpy as np
 import os
 import datetime
-from sklearn.metrics import balanced_accuracy_score
-from sklearn.utils.class_weight import compute_class_weight
 from tqdm import tqdm
 from models import BaseNet
-from utils import save_embedding, load_embedding, load_data
+from utils import get_embedding, load_data, TensorLoader, get_amp_dtype, setup_backends, get_class_weights, \
+    class_weight_tensor, add_confusion, balanced_accuracy
 from transformers import get_linear_schedule_with_warmup
 
 parser = argparse.ArgumentParser(description='Crazy Stuff')
@@ -53,106 +51,99 @@ def train(args, text_train, labels_train, text_val, labels_val, text_test, label
     print("Running on gpu {}".format(args.gpu))
     model.to(f'cuda:{args.gpu[0]}')
 
-    if not args.compute_emb:
-        embedding_train, mask_train = load_embedding(args, fname, 'train')
-        embedding_val, mask_val = load_embedding(args, fname, 'val')
-        embedding_test, mask_test = load_embedding(args, fname, 'test')
-    else:
-        embedding_train, mask_train = model.compute_embedding(text_train, args)
-        embedding_val, mask_val = model.compute_embedding(text_val, args)
-        embedding_test, mask_test = model.compute_embedding(text_test, args)
-        save_embedding(embedding_train, mask_train, args, fname, 'train')
-        save_embedding(embedding_val, mask_val, args, fname, 'val')
-        save_embedding(embedding_test, mask_test, args, fname, 'test')
-        torch.cuda.empty_cache()  # free up language model from GPU
+    embedding_train, mask_train = get_embedding(args, model, text_train, fname, 'train')
+    embedding_val, mask_val = get_embedding(args, model, text_val, fname, 'val')
+    embedding_test, mask_test = get_embedding(args, model, text_test, fname, 'test')
+    torch.cuda.empty_cache()  # free up language model from GPU
 
     num_epochs = args.num_epochs
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
-    ce_crit = torch.nn.CrossEntropyLoss(weight=torch.tensor(args.class_weights).float().to(f'cuda:{args.gpu[0]}'))
+    ce_crit = torch.nn.CrossEntropyLoss(weight=class_weight_tensor(args.class_weights, f'cuda:{args.gpu[0]}'))
     scheduler = get_linear_schedule_with_warmup(optimizer, min(10, num_epochs // 20), num_epochs)
+    # mixed precision, loss scaling is only needed for fp16
+    amp_dtype = get_amp_dtype()
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
 
     model.train()
     print(f"\nStarting training for {num_epochs} epochs\n")
     best_acc = 0
-    train_batches = torch.utils.data.DataLoader(list(zip(embedding_train, labels_train)), batch_size=args.batch_size,
-                                                shuffle=True, pin_memory=True, num_workers=0)  # , drop_last=True)
-    val_batches = torch.utils.data.DataLoader(list(zip(embedding_val, labels_val)), batch_size=args.batch_size,
-                                              shuffle=False, pin_memory=True, num_workers=0)  # , drop_last=True)
+    # keep the precomputed embeddings on the gpu for the whole run instead of copying every batch
+    device = f'cuda:{args.gpu[0]}'
+    train_batches = TensorLoader(embedding_train, labels_train, batch_size=args.batch_size, shuffle=True,
+                                 drop_last=True, device=device)
+    val_batches = TensorLoader(embedding_val, labels_val, batch_size=args.batch_size, device=device)
     for epoch in tqdm(range(num_epochs)):
-        all_preds, all_labels = [], []
-        losses_per_batch = []
+        confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device=device)
+        # running loss sum stays on the gpu and is only transferred once per epoch
+        loss_sum, n_batches = torch.zeros((), device=device), 0
 
         for emb_batch, label_batch in train_batches:
-            emb_batch = emb_batch.to(f'cuda:{args.gpu[0]}')
-            label_batch = label_batch.to(f'cuda:{args.gpu[0]}')
-
-            optimizer.zero_grad()
-            predicted_label = model.forward(emb_batch, [])
-
-            # compute individual losses and backward step
-            loss = ce_crit(predicted_label, label_batch)
-            _, predicted = torch.max(predicted_label.data, 1)
-            all_preds += predicted.cpu().numpy().tolist()
-            all_labels += label_batch.cpu().numpy().tolist()
-
-            loss.backward()
-            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            with torch.cuda.amp.autocast(dtype=amp_dtype):
+                predicted_label = model.forward(emb_batch, [])
+
+                # compute individual losses and backward step
+                loss = ce_crit(predicted_label, label_batch)
+            predicted = predicted_label.argmax(dim=1)
+            add_confusion(confusion, predicted, label_batch)
+
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             # store losses
-            losses_per_batch.append(float(loss))
+            loss_sum += loss.detach()
+            n_batches += 1
 
         scheduler.step()
-        mean_loss = np.mean(losses_per_batch)
-        acc = balanced_accuracy_score(all_labels, all_preds)
+        mean_loss = (loss_sum / n_batches).item()
+        acc = balanced_accuracy(confusion)
         print(f"Epoch {epoch + 1}, mean loss {mean_loss:.3f}, train acc {100 * acc:.4f}")
 
         if (epoch + 1) % args.val_epoch == 0 or epoch + 1 == num_epochs:
             model.eval()
-            all_preds = []
-            all_labels = []
-            losses_per_batch = []
-            with torch.no_grad():
-                for emb_batch, label_batch in val_batches:
-                    emb_batch = emb_batch.to(f'cuda:{args.gpu[0]}')
-                    label_batch = label_batch.to(f'cuda:{args.gpu[0]}')
-                    predicted_label = model.forward(emb_batch, [])
-
-                    # compute individual losses and backward step
-                    loss = ce_crit(predicted_label, label_batch)
-                    losses_per_batch.append(float(loss))
-                    _, predicted = torch.max(predicted_label.data, 1)
-                    all_preds += predicted.cpu().numpy().tolist()
-                    all_labels += label_batch.cpu().numpy().tolist()
-
-                loss_val = np.mean(losses_per_batch)
-                acc_val = balanced_accuracy_score(all_labels, all_preds)
-                print(f"Validation: mean loss {loss_val:.3f}, acc_val {100 * acc_val:.3f}")
-
-                if acc_val > best_acc:
-                    best_acc = acc_val
-                    best_model = model.state_dict()
+            try:
+                confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device=device)
+                loss_sum, n_batches = torch.zeros((), device=device), 0
+                with torch.inference_mode(), torch.cuda.amp.autocast(dtype=amp_dtype):
+                    for emb_batch, label_batch in val_batches:
+                        predicted_label = model.forward(emb_batch, [])
+
+                        # compute individual losses and backward step
+                        loss = ce_crit(predicted_label, label_batch)
+                        loss_sum += loss
+                        n_batches += 1
+                        predicted = predicted_label.argmax(dim=1)
+                        add_confusion(confusion, predicted, label_batch)
+
+                    loss_val = (loss_sum / n_batches).item()
+                    acc_val = balanced_accuracy(confusion)
+                    print(f"Validation: mean loss {loss_val:.3f}, acc_val {100 * acc_val:.3f}")
+
+                    if acc_val > best_acc:
+                        best_acc = acc_val
+                        best_model = model.state_dict()
+            finally:
+                # back to training mode for the following epochs
+                model.train()
 
     model.load_state_dict(best_model)
     model.eval()
 
-    all_preds = []
-    all_labels = []
-    losses_per_batch = []
-    test_batches = torch.utils.data.DataLoader(list(zip(embedding_test, labels_test)), batch_size=args.batch_size,
-                                               shuffle=False, pin_memory=True, num_workers=0)  # , drop_last=True)
-    with torch.no_grad():
+    confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device=device)
+    loss_sum, n_batches = torch.zeros((), device=device), 0
+    test_batches = TensorLoader(embedding_test, labels_test, batch_size=args.batch_size, device=device)
+    with torch.inference_mode():
         for emb_batch, label_batch in test_batches:
-            emb_batch = emb_batch.to(f'cuda:{args.gpu[0]}')
-            label_batch = label_batch.to(f'cuda:{args.gpu[0]}')
             predicted_label = model.forward(emb_batch, [])
             loss = ce_crit(predicted_label, label_batch)
 
-            losses_per_batch.append(float(loss))
-            _, predicted = torch.max(predicted_label.data, 1)
-            all_preds += predicted.cpu().numpy().tolist()
-            all_labels += label_batch.cpu().numpy().tolist()
+            loss_sum += loss
+            n_batches += 1
+            predicted = predicted_label.argmax(dim=1)
+            add_confusion(confusion, predicted, label_batch)
 
-        loss = np.mean(losses_per_batch)
-        acc_test = balanced_accuracy_score(all_labels, all_preds)
+        loss = (loss_sum / n_batches).item()
+        acc_test = balanced_accuracy(confusion)
         print(f"test evaluation on best model: loss {loss:.3f}, acc_test {100 * acc_test:.3f}")
 
     save_path = f"./trained_{args.language_model}_BaseClassifier/{args.data_name}/model.pt"
@@ -165,6 +156,7 @@ if __name__ == '__main__':
     # torch.manual_seed(0)
     # np.random.seed(0)
     # torch.set_num_threads(6)
+    setup_backends()
     args = parser.parse_args()
 
     fname = args.language_model
@@ -176,6 +168,6 @@ if __name__ == '__main__':
     text_train, text_val, text_test, labels_train, labels_val, labels_test = load_data(args)
 
     # set class weights for balanced loss computation
-    args.class_weights = compute_class_weight(class_weight='balanced', classes=np.unique(labels_train), y=labels_train)
+    args.class_weights = get_class_weights(labels_train)
 
     model = train(args, text_train, labels_train, text_val, labels_val, text_test, labels_test)
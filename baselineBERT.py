@@ -1,10 +1,7 @@
 import argparse
 import torch
-import numpy as np
-from sklearn.metrics import balanced_accuracy_score
-from sklearn.utils.class_weight import compute_class_weight
 from tqdm import tqdm
-from utils import load_data
+from utils import load_data, setup_backends, get_class_weights, class_weight_tensor, add_confusion, balanced_accuracy
 import logging
 from transformers import AdamW, BertTokenizer, GPT2Tokenizer, DistilBertTokenizer
 from transformers import get_linear_schedule_with_warmup
@@ -85,7 +82,7 @@ def train(args, text_train, labels_train, text_val, labels_val, text_test, label
     num_epochs = args.num_epochs
     optimizer = AdamW(optimizer_grouped_parameters, lr=1e-5)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_epochs // 10, num_epochs)
-    ce_crit = torch.nn.CrossEntropyLoss(weight=torch.tensor(args.class_weights).float().to('cuda'))
+    ce_crit = torch.nn.CrossEntropyLoss(weight=class_weight_tensor(args.class_weights, 'cuda'))
 
     print("\nStarting training for {} epochs\n".format(num_epochs))
     best_acc = 0
@@ -94,9 +91,9 @@ def train(args, text_train, labels_train, text_val, labels_val, text_test, label
     val_batches = torch.utils.data.DataLoader(list(zip(text_val, labels_val)), batch_size=args.batch_size,
                                               shuffle=False, pin_memory=True)
     for epoch in tqdm(range(num_epochs)):
-        losses_per_batch = []
-        all_preds = []
-        all_labels = []
+        # predictions are counted on the gpu, only the final accuracy is transferred
+        confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device='cuda')
+        loss_sum = torch.zeros((), device='cuda')
         for text_batch, label_batch in train_batches:
             encoding = tokenizer(text_batch, return_tensors='pt', padding=True, truncation=True)
             input_ids = encoding['input_ids']
@@ -109,65 +106,66 @@ def train(args, text_train, labels_train, text_val, labels_val, text_test, label
             outputs = model(input_ids, attention_mask=attention_mask, return_dict=True)
             loss = ce_crit(outputs.logits, label_batch)
 
-            _, predicted = torch.max(outputs.logits.data, 1)
-            all_preds += predicted.cpu().numpy().tolist()
-            all_labels += label_batch.cpu().numpy().tolist()
+            predicted = outputs.logits.argmax(dim=1)
+            add_confusion(confusion, predicted, label_batch)
 
             loss.backward()
             optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
             # store losses
-            losses_per_batch.append(float(loss))
+            loss_sum += loss.detach()
 
         scheduler.step()
-        mean_loss = np.mean(losses_per_batch)
+        mean_loss = (loss_sum / len(train_batches)).item()
 
-        acc = balanced_accuracy_score(all_labels, all_preds)
+        acc = balanced_accuracy(confusion)
         print("Epoch {}, mean loss {:.4f}, train acc {:.4f}".format(epoch + 1,
                                                                     mean_loss,
                                                                     100 * acc))
 
         if (epoch + 1) % args.val_epoch == 0 or epoch + 1 == num_epochs:
             model.eval()
-            all_preds = []
-            all_labels = []
-            losses_per_batch = []
-            with torch.no_grad():
-                for text_batch, label_batch in val_batches:
-                    encoding = tokenizer(text_batch, return_tensors='pt', padding=True, truncation=True)
-                    input_ids = encoding['input_ids']
-                    attention_mask = encoding['attention_mask']
-
-                    input_ids = input_ids.to('cuda')
-                    attention_mask = attention_mask.to('cuda')
-                    label_batch = label_batch.to('cuda')
-
-                    outputs = model(input_ids, attention_mask=attention_mask, return_dict=True)
-                    loss = ce_crit(outputs.logits, label_batch)
-
-                    _, predicted = torch.max(outputs.logits.data, 1)
-                    all_preds += predicted.cpu().numpy().tolist()
-                    all_labels += label_batch.cpu().numpy().tolist()
-
-                    # store losses
-                    losses_per_batch.append(float(loss))
-
-                loss = np.mean(losses_per_batch)
-                acc_val = balanced_accuracy_score(all_labels, all_preds)
-                print(f"test evaluation on best model: loss {loss:.4f}, acc_val {100 * acc_val:.3f}")
-
-                if acc_val > best_acc:
-                    best_acc = acc_val
-                    best_model = model.state_dict()
+            try:
+                confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device='cuda')
+                loss_sum = torch.zeros((), device='cuda')
+                with torch.inference_mode():
+                    for text_batch, label_batch in val_batches:
+                        encoding = tokenizer(text_batch, return_tensors='pt', padding=True, truncation=True)
+                        input_ids = encoding['input_ids']
+                        attention_mask = encoding['attention_mask']
+
+                        input_ids = input_ids.to('cuda')
+                        attention_mask = attention_mask.to('cuda')
+                        label_batch = label_batch.to('cuda')
+
+                        outputs = model(input_ids, attention_mask=attention_mask, return_dict=True)
+                        loss = ce_crit(outputs.logits, label_batch)
+
+                        predicted = outputs.logits.argmax(dim=1)
+                        add_confusion(confusion, predicted, label_batch)
+
+                        # store losses
+                        loss_sum += loss
+
+                    loss = (loss_sum / len(val_batches)).item()
+                    acc_val = balanced_accuracy(confusion)
+                    print(f"test evaluation on best model: loss {loss:.4f}, acc_val {100 * acc_val:.3f}")
+
+                    if acc_val > best_acc:
+                        best_acc = acc_val
+                        best_model = model.state_dict()
+            finally:
+                # back to training mode for the following epochs
+                model.train()
 
     model.load_state_dict(best_model)
     model.eval()
 
-    all_preds = []
-    all_labels = []
-    losses_per_batch = []
+    confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device='cuda')
+    loss_sum = torch.zeros((), device='cuda')
     test_batches = torch.utils.data.DataLoader(list(zip(text_test, labels_test)), batch_size=args.batch_size,
                                                shuffle=False, pin_memory=True, num_workers=0)  # , drop_last=True)
-    with torch.no_grad():
+    with torch.inference_mode():
         for text_batch, label_batch in test_batches:
             encoding = tokenizer(text_batch, return_tensors='pt', padding=True, truncation=True)
             input_ids = encoding['input_ids']
@@ -180,15 +178,14 @@ def train(args, text_train, labels_train, text_val, labels_val, text_test, label
             outputs = model(input_ids, attention_mask=attention_mask, return_dict=True)
             loss = ce_crit(outputs.logits, label_batch)
 
-            _, predicted = torch.max(outputs.logits.data, 1)
-            all_preds += predicted.cpu().numpy().tolist()
-            all_labels += label_batch.cpu().numpy().tolist()
+            predicted = outputs.logits.argmax(dim=1)
+            add_confusion(confusion, predicted, label_batch)
 
             # store losses
-            losses_per_batch.append(float(loss))
+            loss_sum += loss
 
-        loss = np.mean(losses_per_batch)
-        acc_test = balanced_accuracy_score(all_labels, all_preds)
+        loss = (loss_sum / len(test_batches)).item()
+        acc_test = balanced_accuracy(confusion)
         print(f"test evaluation on best model: loss {loss:.3f}, acc_test {100 * acc_test:.3f}")
 
     save_path = f"./trained_{args.language_model}_BaseClassifier/{args.data_name}/model.pt"
@@ -200,11 +197,12 @@ if __name__ == '__main__':
     # torch.manual_seed(0)
     # np.random.seed(0)
     # torch.set_num_threads(6)
+    setup_backends()
     args = parser.parse_args()
 
     text_train, text_val, text_test, labels_train, labels_val, labels_test = load_data(args)
 
     # set class weights for balanced loss computation
-    args.class_weights = compute_class_weight(class_weight='balanced', classes=np.unique(labels_train), y=labels_train)
+    args.class_weights = get_class_weights(labels_train)
 
     train(args, text_train, labels_train, text_val, labels_val, text_test, labels_test)
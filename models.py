@@ -87,10 +87,10 @@ class ProtoTrexS(nn.Module):
             LM, preprocess = clip.load('ViT-L/14', f'cuda:{args.gpu[0]}')
             # x = preprocess(x).unsqueeze(0)  # in case of image as input
             x = clip.tokenize(x, truncate=True)
-            batches = torch.utils.data.DataLoader(x, batch_size=200, shuffle=False)
             embedding = []
-            for batch in batches:
-                batch = batch.to(f'cuda:{args.gpu[0]}')
+            # x is already one tensor, slice it directly instead of collating single rows with a DataLoader
+            for i in range(0, len(x), 200):
+                batch = x[i:i + 200].to(f'cuda:{args.gpu[0]}')
                 output = LM.encode_text(batch)
                 # output = LM.encode_image(batch)
                 embedding.append(output.cpu().detach().float())
@@ -193,7 +193,6 @@ class ProtoTrexW(nn.Module):
             param.requires_grad = False
 
         bs = 10  # divide data by a batch size if too big for memory to process embedding at once
-        word_embedding = []
         if not max_l:
             inputs = self.tokenizer(x, return_tensors='pt', padding=True, add_special_tokens=False)
         elif max_l:
@@ -201,12 +200,15 @@ class ProtoTrexW(nn.Module):
                                     add_special_tokens=False)
         inputs_ = {'input_ids': [], 'attention_mask': []}
         attn_mask = inputs['attention_mask']
-        for i in range(0, len(x), bs):
+        word_embedding = []
+        # x can be a single string, so take the number of rows from the tokenizer output instead of len(x)
+        n = inputs['input_ids'].size(0)
+        for i in range(0, n, bs):
             inputs_['input_ids'] = inputs['input_ids'][i:i + bs].to(f'cuda:{args.gpu[0]}')
             inputs_['attention_mask'] = inputs['attention_mask'][i:i + bs].to(f'cuda:{args.gpu[0]}')
             outputs = LM(inputs_['input_ids'], attention_mask=inputs_['attention_mask'])
-            word_embedding.extend(outputs[0].cpu().detach())
-        embedding = torch.stack(word_embedding, dim=0)
+            word_embedding.append(outputs[0].cpu().detach())
+        embedding = torch.cat(word_embedding, dim=0)
         return embedding, attn_mask
 
     def compute_attention(self, embedding, mask):
@@ -254,7 +256,8 @@ class ProtoTrexW(nn.Module):
                 # cut off combinations that contain padding, still keep for every example at least one combination, even
                 # if it contains padding
                 overlap = d * (K - 1)
-                m = mask[:, overlap:].unsqueeze(1)
+                # copy, the mask is a view of the stored data and must not be changed in place
+                m = mask[:, overlap:].unsqueeze(1).clone()
                 m[:, :, 0] = 1
                 dist = dist * m
                 distances.append(dist)
@@ -287,14 +290,12 @@ class ProtoTrexW(nn.Module):
         nearest_patch = argmin_dist[nearest_sent, torch.arange(self.num_prototypes)].cpu().detach().numpy()
 
         # get text for prototypes
-        text_nearest, nearest_words, proto_texts, proto_ids = [], [], [], []
-        text_tknzd = self.tokenizer(text_train, return_tensors='pt', padding=True, add_special_tokens=False).input_ids
+        nearest_words, proto_texts, proto_ids = [], [], []
         if self.attn:
             top_w = torch.cat(top_w, dim=0).cpu().detach().numpy()
             c = torch.combinations(torch.arange(top_w.shape[1]), r=self.proto_size)
             word_ids = c[nearest_patch]
             nearest_words = top_w[np.expand_dims(nearest_sent, -1), word_ids]
-            text_nearest = text_tknzd[nearest_sent]
         else:
             j = 0
             for d, n in zip(self.dilated, self.num_filters):
@@ -302,11 +303,20 @@ class ProtoTrexW(nn.Module):
                 # also add padding required by convolution
                 nearest_words.extend(
                     [[word_id + x * d for x in range(self.proto_size)] for word_id in nearest_patch[j:j + n]])
-                text_nearest.extend(text_tknzd[nearest_sent[j:j + n]])
                 j += n
-
-        for i, (s_index, w_indices) in enumerate(zip(nearest_sent, nearest_words)):
-            token2text = self.tokenizer.decode(text_nearest[i][w_indices].tolist())
+            nearest_words = np.asarray(nearest_words)
+
+        # only tokenize the sentences that are nearest to a prototype instead of the whole training set
+        needed, rows = np.unique(nearest_sent, return_inverse=True)
+        tknzd = self.tokenizer([text_train[i] for i in needed], add_special_tokens=False).input_ids
+        # word ids can point into the padding of the longest training sentence, so pad wide enough for all of them
+        width = max(max(len(t) for t in tknzd), int(nearest_words.max()) + 1)
+        text_tknzd = torch.full((len(needed), width), self.tokenizer.pad_token_id, dtype=torch.long)
+        for k, t in enumerate(tknzd):
+            text_tknzd[k, :len(t)] = torch.as_tensor(t, dtype=torch.long)
+        # gather the tokens of all prototypes at once, [num_prototypes x proto_size], and decode them in one call
+        text_nearest = text_tknzd[torch.as_tensor(rows).unsqueeze(-1), torch.as_tensor(nearest_words)]
+        for i, (s_index, token2text) in enumerate(zip(nearest_sent, self.tokenizer.batch_decode(text_nearest.tolist()))):
             proto_ids.append(
                 f'P{i + 1} | sentence {s_index} | label {labels_train[s_index]} | text: {text_train[s_index]}| proto: ')
             proto_texts.append(f'{token2text}')
@@ -391,10 +401,9 @@ class ProtoClip(ProtoTrexS):
     def compute_embedding(x, args, max_l=False):
         LM, preprocess = clip.load('ViT-B/16', f'cuda:{args.gpu[0]}')
         x = preprocess(x).unsqueeze(0)
-        batches = torch.utils.data.DataLoader(x, batch_size=200, shuffle=False)
         embedding = []
-        for batch in batches:
-            batch = batch.to(f'cuda:{args.gpu[0]}')
+        for i in range(0, len(x), 200):
+            batch = x[i:i + 200].to(f'cuda:{args.gpu[0]}')
             output = LM.encode_image(batch)
             embedding.append(output.cpu().detach().float())
         embedding = torch.cat(embedding, dim=0)
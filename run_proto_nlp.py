@@ -9,16 +9,16 @@ import torch
 import numpy as np
 import pandas as pd
 from sklearn.metrics import balanced_accuracy_score
-from sklearn.utils.class_weight import compute_class_weight
 from tqdm import tqdm
 # from transformers import get_linear_schedule_with_warmup
 from PIL import Image
 from collections import Counter
 from models import ProtoTrexS, ProtoTrexW
-from utils import save_embedding, load_embedding, load_data, visualize_protos, proto_loss, prune_prototypes, \
+from utils import get_embedding, load_data, visualize_protos, proto_loss, prune_prototypes, \
     get_nearest, remove_prototypes, add_prototypes, reinit_prototypes, finetune_prototypes, nearest_image, \
     replace_prototypes, soft_rplc_prototypes, project, preprocess_restaurant, preprocess_jigsaw, transform_explain, robustness, \
-    replace_sentence_prototypes
+    replace_sentence_prototypes, TensorLoader, to_device, combined_loss, get_amp_dtype, setup_backends, get_class_weights, \
+    class_weight_tensor, add_confusion, balanced_accuracy
 
 parser = argparse.ArgumentParser(description='Transformer Prototype Learning')
 parser.add_argument('-m', '--mode', default='train test', type=str, nargs='+',
@@ -30,6 +30,8 @@ parser.add_argument('-e', '--num_epochs', default=200, type=int,
                     help='How many epochs?')
 parser.add_argument('-bs', '--batch_size', default=1024, type=int,
                     help='Select batch size')
+parser.add_argument('--accum_steps', default=1, type=int,
+                    help='Over how many batches should gradients be accumulated before an optimizer step?')
 parser.add_argument('--val_epoch', default=10, type=int,
                     help='After how many epochs should the model be evaluated on the validation data?')
 parser.add_argument('--data_dir', default='./data',
@@ -97,111 +99,101 @@ parser.add_argument('--pid', type=str, default='',
 def train(args, train_batches, val_batches, model, embedding_train, train_batches_unshuffled, text_train, labels_train):
     num_epochs = args.num_epochs
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
-    ce_crit = torch.nn.CrossEntropyLoss(weight=torch.tensor(args.class_weights).float().to(f'cuda:{args.gpu[0]}'))
+    ce_crit = torch.nn.CrossEntropyLoss(weight=class_weight_tensor(args.class_weights, f'cuda:{args.gpu[0]}'))
     # scheduler = get_linear_schedule_with_warmup(optimizer, min(10, num_epochs // 20), num_epochs)
+    # mixed precision, loss scaling is only needed for fp16
+    amp_dtype = get_amp_dtype()
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+    # fuse the small distance/softmin/linear kernels if torch.compile is available (torch>=2.0),
+    # only the forward is compiled so the model and its state_dict keys stay untouched.
+    # batch, prototype and class sizes are fixed python ints for a run, so specialize on static shapes
+    forward = torch.compile(model.forward, mode='reduce-overhead', dynamic=False) if hasattr(torch, 'compile') \
+        else model.forward
+
+    # scale of each logged loss term, the total and ce loss are logged as they are
+    loss_weights = torch.tensor([1, 1, args.lambda1, args.lambda2, args.lambda3, args.lambda4, args.lambda5],
+                                device=f'cuda:{args.gpu[0]}')
 
     print(f'\nStart training for {num_epochs} epochs\n')
     best_acc = 0
 
     for epoch in tqdm(range(num_epochs)):
         model.train()
-        all_preds, all_labels = [], []
-        losses_per_batch = []
-        ce_loss_per_batch = []
-        distr_loss_per_batch = []
-        clust_loss_per_batch = []
-        sep_loss_per_batch = []
-        divers_loss_per_batch = []
-        l1_loss_per_batch = []
+        confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device=f'cuda:{args.gpu[0]}')
+        # running sums of all losses in one vector on the gpu, only transferred once per epoch
+        loss_stats, n_batches = torch.zeros(7, device=f'cuda:{args.gpu[0]}'), 0
 
         # Update the RTPT
         rtpt.step()
 
-        for emb_batch, mask_batch, label_batch in train_batches:
-            emb_batch = emb_batch.to(f'cuda:{args.gpu[0]}')
-            mask_batch = mask_batch.to(f'cuda:{args.gpu[0]}')
-            label_batch = label_batch.to(f'cuda:{args.gpu[0]}')
-
-            optimizer.zero_grad()
-            prototype_distances, predicted_label = model.forward(emb_batch, mask_batch)
-
-            # compute individual losses and backward step
-            ce_loss = ce_crit(predicted_label, label_batch)
-            distr_loss, clust_loss, sep_loss, divers_loss, l1_loss = \
-                proto_loss(prototype_distances, label_batch, model, args)
-            loss = ce_loss + \
-                   args.lambda1 * distr_loss + \
-                   args.lambda2 * clust_loss + \
-                   args.lambda3 * sep_loss + \
-                   args.lambda4 * divers_loss + \
-                   args.lambda5 * l1_loss
-
-            _, predicted = torch.max(predicted_label, 1)
-            all_preds += predicted.cpu().detach().numpy().tolist()
-            all_labels += label_batch.cpu().detach().numpy().tolist()
-
-            loss.backward()
-            optimizer.step()
-            with torch.no_grad():
-                model.fc.weight.copy_(model.fc.weight.clamp(max=0.0))
+        optimizer.zero_grad(set_to_none=True)
+        for i, (emb_batch, mask_batch, label_batch) in enumerate(train_batches):
+            with torch.cuda.amp.autocast(dtype=amp_dtype):
+                prototype_distances, predicted_label = forward(emb_batch, mask_batch)
+
+                # compute individual losses and backward step
+                ce_loss = ce_crit(predicted_label, label_batch)
+                distr_loss, clust_loss, sep_loss, divers_loss, l1_loss = \
+                    proto_loss(prototype_distances, label_batch, model, args)
+                loss = combined_loss(ce_loss, distr_loss, clust_loss, sep_loss, divers_loss, l1_loss,
+                                     args.lambda1, args.lambda2, args.lambda3, args.lambda4, args.lambda5)
+
+            predicted = predicted_label.argmax(dim=1)
+            add_confusion(confusion, predicted.detach(), label_batch)
+
+            # average over the batches of the current group, the last group of an epoch can be shorter
+            group_size = min(args.accum_steps, len(train_batches) - (i // args.accum_steps) * args.accum_steps)
+            scaler.scale(loss / group_size).backward()
+            # step only every accum_steps batches to emulate a larger batch, the last batch flushes the remainder
+            if (i + 1) % args.accum_steps == 0 or i + 1 == len(train_batches):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                with torch.no_grad():
+                    model.fc.weight.copy_(model.fc.weight.clamp(max=0.0))
 
             # store losses
-            losses_per_batch.append(float(loss))
-            ce_loss_per_batch.append(float(ce_loss))
-            distr_loss_per_batch.append(float(args.lambda1 * distr_loss))
-            clust_loss_per_batch.append(float(args.lambda2 * clust_loss))
-            sep_loss_per_batch.append(float(args.lambda3 * sep_loss))
-            divers_loss_per_batch.append(float(args.lambda4 * divers_loss))
-            l1_loss_per_batch.append(float(args.lambda5 * l1_loss))
+            loss_stats += torch.stack([l.detach().float() for l in
+                                       (loss, ce_loss, distr_loss, clust_loss, sep_loss, divers_loss, l1_loss)])
+            n_batches += 1
 
         # scheduler.step()
-        mean_loss = np.mean(losses_per_batch)
-        ce_mean_loss = np.mean(ce_loss_per_batch)
-        distr_mean_loss = np.mean(distr_loss_per_batch)
-        clust_mean_loss = np.mean(clust_loss_per_batch)
-        sep_mean_loss = np.mean(sep_loss_per_batch)
-        divers_mean_loss = np.mean(divers_loss_per_batch)
-        l1_mean_loss = np.mean(l1_loss_per_batch)
-        acc = balanced_accuracy_score(all_labels, all_preds)
+        mean_loss, ce_mean_loss, distr_mean_loss, clust_mean_loss, sep_mean_loss, divers_mean_loss, l1_mean_loss = \
+            (loss_stats * loss_weights / n_batches).tolist()
+        acc = balanced_accuracy(confusion)
         print(f'Epoch {epoch + 1}, losses: mean {mean_loss:.3f}, ce {ce_mean_loss:.3f}, distr {distr_mean_loss:.3f}, '
               f'clust {clust_mean_loss:.3f}, sep {sep_mean_loss:.3f}, divers {divers_mean_loss:.3f}, '
               f'l1 {l1_mean_loss:.3f}, train acc {100 * acc:.3f}')
 
         if ((epoch + 1) % args.val_epoch == 0) and ((epoch + 1) > (num_epochs * 2 // 10)) or (epoch + 1 == num_epochs):
             model.eval()
-            all_preds = []
-            all_labels = []
-            losses_per_batch = []
-            with torch.no_grad():
+            confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device=f'cuda:{args.gpu[0]}')
+            loss_sum, n_batches = torch.zeros((), device=f'cuda:{args.gpu[0]}'), 0
+            with torch.inference_mode(), torch.cuda.amp.autocast(dtype=amp_dtype):
                 for emb_batch, mask_batch, label_batch in val_batches:
-                    emb_batch = emb_batch.to(f'cuda:{args.gpu[0]}')
-                    mask_batch = mask_batch.to(f'cuda:{args.gpu[0]}')
-                    label_batch = label_batch.to(f'cuda:{args.gpu[0]}')
-                    prototype_distances, predicted_label = model.forward(emb_batch, mask_batch)
+                    prototype_distances, predicted_label = forward(emb_batch, mask_batch)
 
                     # compute individual losses and backward step
                     ce_loss = ce_crit(predicted_label, label_batch)
                     distr_loss, clust_loss, sep_loss, divers_loss, l1_loss = \
                         proto_loss(prototype_distances, label_batch, model, args)
-                    loss = ce_loss + \
-                           args.lambda1 * distr_loss + \
-                           args.lambda2 * clust_loss + \
-                           args.lambda3 * sep_loss + \
-                           args.lambda4 * divers_loss + \
-                           args.lambda5 * l1_loss
-
-                    losses_per_batch.append(float(loss))
-                    _, predicted = torch.max(predicted_label, 1)
-                    all_preds += predicted.detach().cpu().numpy().tolist()
-                    all_labels += label_batch.cpu().detach().numpy().tolist()
-
-                loss_val = np.mean(losses_per_batch)
-                acc_val = balanced_accuracy_score(all_labels, all_preds)
+                    loss = combined_loss(ce_loss, distr_loss, clust_loss, sep_loss, divers_loss, l1_loss,
+                                         args.lambda1, args.lambda2, args.lambda3, args.lambda4, args.lambda5)
+
+                    loss_sum += loss
+                    n_batches += 1
+                    predicted = predicted_label.argmax(dim=1)
+                    add_confusion(confusion, predicted, label_batch)
+
+                loss_val = (loss_sum / n_batches).item()
+                acc_val = balanced_accuracy(confusion)
                 print(f'Validation: mean loss {loss_val:.3f}, acc_val {100 * acc_val:.3f}')
 
                 if acc_val > best_acc:
                     best_acc = acc_val
-                    state = {'state_dict': model.state_dict(), 'hyper_params': args, 'acc_val': acc_val}
+                    # plain hyperparameter values only, tensors like the prototype class identity stay out of the checkpoint
+                    hyper_params = {k: v for k, v in vars(args).items() if not torch.is_tensor(v)}
+                    state = {'state_dict': model.state_dict(), 'hyper_params': hyper_params, 'acc_val': acc_val}
 
         # project prototypes
         if (epoch + 1) % 5 == 0 and args.project and (num_epochs * 2 // 10) < (epoch + 1) < (num_epochs * 8 // 10):
@@ -216,43 +208,42 @@ def train(args, train_batches, val_batches, model, embedding_train, train_batche
 
     model.load_state_dict(state['state_dict'])
     torch.save(state, args.model_path)
+    # remember the latest checkpoint so later runs do not have to scan all training results,
+    # only models the fallback glob in main would pick up too (no robustness checkpoints)
+    if args.model_path.endswith('best_model.pth.tar'):
+        with open(f'./experiments/train_results/latest_{args.language_model}_{args.data_name}.txt', 'w') as f:
+            f.write(args.model_path)
     return model
 
 
 def test(args, embedding_train, mask_train, train_batches_unshuffled, test_batches, labels_train, text_train, model):
     print('\nStart evaluation, loading model:', args.model_path)
     model.eval()
-    ce_crit = torch.nn.CrossEntropyLoss(weight=torch.tensor(args.class_weights).float().to(f'cuda:{args.gpu[0]}'))
-
-    all_preds = []
-    all_labels = []
-    losses_per_batch = []
-
-    with torch.no_grad():
-        for emb_batch, mask_batch, label_batch in test_batches:
-            emb_batch = emb_batch.to(f'cuda:{args.gpu[0]}')
-            mask_batch = mask_batch.to(f'cuda:{args.gpu[0]}')
-            label_batch = label_batch.to(f'cuda:{args.gpu[0]}')
-            prototype_distances, predicted_label = model.forward(emb_batch, mask_batch)
-
-            # compute individual losses
-            ce_loss = ce_crit(predicted_label, label_batch)
-            distr_loss, clust_loss, sep_loss, divers_loss, l1_loss = \
-                proto_loss(prototype_distances, label_batch, model, args)
-            loss = ce_loss + \
-                   args.lambda1 * distr_loss + \
-                   args.lambda2 * clust_loss + \
-                   args.lambda3 * sep_loss + \
-                   args.lambda4 * divers_loss + \
-                   args.lambda5 * l1_loss
-
-            losses_per_batch.append(float(loss))
-            _, predicted = torch.max(predicted_label, 1)
-            all_preds += predicted.cpu().detach().numpy().tolist()
-            all_labels += label_batch.cpu().detach().numpy().tolist()
-
-        loss = np.mean(losses_per_batch)
-        acc_test = balanced_accuracy_score(all_labels, all_preds)
+    ce_crit = torch.nn.CrossEntropyLoss(weight=class_weight_tensor(args.class_weights, f'cuda:{args.gpu[0]}'))
+
+    confusion = torch.zeros(args.num_classes, args.num_classes, dtype=torch.long, device=f'cuda:{args.gpu[0]}')
+    loss_sum, n_batches = torch.zeros((), device=f'cuda:{args.gpu[0]}'), 0
+
+    with torch.inference_mode():
+        # mixed precision forward, no scaler needed without backward
+        with torch.cuda.amp.autocast(dtype=get_amp_dtype()):
+            for emb_batch, mask_batch, label_batch in test_batches:
+                prototype_distances, predicted_label = model.forward(emb_batch, mask_batch)
+
+                # compute individual losses
+                ce_loss = ce_crit(predicted_label, label_batch)
+                distr_loss, clust_loss, sep_loss, divers_loss, l1_loss = \
+                    proto_loss(prototype_distances, label_batch, model, args)
+                loss = combined_loss(ce_loss, distr_loss, clust_loss, sep_loss, divers_loss, l1_loss,
+                                     args.lambda1, args.lambda2, args.lambda3, args.lambda4, args.lambda5)
+
+                loss_sum += loss
+                n_batches += 1
+                predicted = predicted_label.argmax(dim=1)
+                add_confusion(confusion, predicted, label_batch)
+
+        loss = (loss_sum / n_batches).item()
+        acc_test = balanced_accuracy(confusion)
         print(f'Test evaluation on best model: loss {loss:.3f}, acc_test {100 * acc_test:.3f}')
 
         # "convert" prototype embedding to text (take text of nearest training sample)
@@ -292,7 +283,7 @@ def test(args, embedding_train, mask_train, train_batches_unshuffled, test_batch
 
         # plot prototypes
         prototypes = model.get_protos().cpu().numpy()
-        visualize_protos(args, embedding_train.cpu().numpy(), mask_train, labels_train, prototypes, model, proto_labels)
+        visualize_protos(args, embedding_train.cpu().numpy(), mask_train.cpu(), labels_train, prototypes, model, proto_labels)
 
 
 def query(args, train_batches_unshuffled, labels_train, text_train, model):
@@ -335,6 +326,15 @@ def query(args, train_batches_unshuffled, labels_train, text_train, model):
     txt_file.close()
 
 
+def survey_forward(args, model, texts):
+    embedding, mask = model.compute_embedding(list(texts), args)
+    torch.cuda.empty_cache()  # is required since BERT encoding is only possible on 1 GPU (memory limitation)
+    with torch.no_grad():
+        prototype_distances, predicted_labels = model.forward(embedding.to(f'cuda:{args.gpu[0]}'),
+                                                              mask.to(f'cuda:{args.gpu[0]}'))
+    return prototype_distances.view(len(texts), -1).cpu(), predicted_labels.view(len(texts), -1).cpu()
+
+
 def survey(args, train_batches_unshuffled, labels_train, text_train, text_test, labels_test, model):
     '''
     Function samples 100 datapoints from the test set and creates 4(8) different csv files.
@@ -361,20 +361,15 @@ def survey(args, train_batches_unshuffled, labels_train, text_train, text_test,
         dictionary = {}
         dictionary['Input'] = random_texts
         dictionary['True Label'] = random_labels
-        
+
+        # embed and classify all samples at once instead of loading the language model for every single sample
+        prototype_distances, predicted_labels = survey_forward(args, model, random_texts)
+
         # iterate over each entry in the dictionary and add the predicted labels as well as the explanations to the dictionary
-        for text in random_texts:
+        for j in range(len(random_texts)):
             rtpt.step()
-            args.query = text
-            embedding_query, mask_query = model.compute_embedding(args.query, args)
-            embedding_query = embedding_query.to(f'cuda:{args.gpu[0]}')
-            mask_query = mask_query.to(f'cuda:{args.gpu[0]}')
-            args.query = args.query[0]
-            torch.cuda.empty_cache() # is required since BERT encoding is only possible on 1 GPU (memory limitation)
-        
-            prototype_distances, predicted_label = model.forward(embedding_query, mask_query)
-            predicted = torch.argmax(predicted_label).cpu().detach()
-            query2proto = torch.topk(prototype_distances.cpu().detach().squeeze(), k=1, largest=False)
+            predicted = torch.argmax(predicted_labels[j])
+            query2proto = torch.topk(prototype_distances[j], k=1, largest=False)
             nearest_proto = proto_texts[query2proto[1]]
         
             #add prediction to dictionary
@@ -427,22 +422,15 @@ def survey(args, train_batches_unshuffled, labels_train, text_train, text_test,
         dictionary = {}
         dictionary['Input'] = random_texts
         dictionary['True Label'] = random_labels
-        for text in random_texts:
+
+        # prototypes and weights do not change between samples, embed and classify all samples at once
+        prototype_distances, predicted_labels = survey_forward(args, model, random_texts)
+        weights = model.get_proto_weights()
+        k = 5 #args.num_prototypes
+        for j in range(len(random_texts)):
             rtpt.step()
-            args.query = text
-            embedding_query, mask_query = model.compute_embedding(args.query, args)
-            embedding_query = embedding_query.to(f'cuda:{args.gpu[0]}')
-            mask_query = mask_query.to(f'cuda:{args.gpu[0]}')
-            args.query = args.query[0]
-            #torch.cuda.empty_cache()  # is required since BERT encoding is only possible on 1 GPU (memory limitation)
-
-            # "convert" prototype embedding to text (take text of nearest training sample)
-            _, proto_texts, _ = get_nearest(args, model, train_batches_unshuffled, text_train, labels_train)
-            prototype_distances, predicted_label = model.forward(embedding_query, mask_query)
-            predicted = torch.argmax(predicted_label).cpu().detach()
-            k = 5 #args.num_prototypes
-            query2proto = torch.topk(prototype_distances.cpu().detach().squeeze(), k=k, largest=False)
-            weights = model.get_proto_weights()
+            predicted = torch.argmax(predicted_labels[j])
+            query2proto = torch.topk(prototype_distances[j], k=k, largest=False)
             weight = - weights[query2proto[1], predicted]
             similarity = - query2proto[0]
             scores = []
@@ -587,47 +575,32 @@ def explain(args, embedding_test, mask_test, text_test, labels_test, model, trai
 
         explained_test_samples.append(values)
 
-        for i in range(len(labels_test)):
-            emb = embedding_test[i].to(f'cuda:{args.gpu[0]}').unsqueeze(0)
-            mask = mask_test[i].to(f'cuda:{args.gpu[0]}').unsqueeze(0)
-            prototype_distances, predicted_label = model.forward(emb, mask)
-            predicted = torch.argmax(predicted_label).cpu().detach()
-            probability = torch.nn.functional.softmax(predicted_label, dim=1).squeeze().tolist()
-            similarity_score = prototype_distances.cpu().detach().squeeze() * weights[:, predicted]
-            top_scores = similarity_score
-
-            values = [''.join(text_test[i]) + '\n', f'{int(labels_test[i])}\n', f'{int(predicted)}\n',
-                      f'{probability[0]:.3f}\n', f'{probability[1]:.3f}\n']
-            for j in range(args.num_prototypes):
-                idx = j
-                nearest_proto = proto_texts[idx]
-                values.append(f'{nearest_proto}\n')
-                values.append(f'{idx + 1}\n')
-                values.append(f'{float(-prototype_distances[:, idx]):.3f}\n')
-                values.append(f'{float(-weights[idx, predicted]):.3f}\n')
-                values.append(f'{float(top_scores[j]):.3f}\n')
-            explained_test_samples.append(values)
-
-        for i in range(len(labels_val)):
-            emb = embedding_val[i].to(f'cuda:{args.gpu[0]}').unsqueeze(0)
-            mask = mask_val[i].to(f'cuda:{args.gpu[0]}').unsqueeze(0)
-            prototype_distances, predicted_label = model.forward(emb, mask)
-            predicted = torch.argmax(predicted_label).cpu().detach()
-            probability = torch.nn.functional.softmax(predicted_label, dim=1).squeeze().tolist()
-            similarity_score = prototype_distances.cpu().detach().squeeze() * weights[:, predicted]
-            top_scores = similarity_score
-
-            values = [''.join(text_val[i]) + '\n', f'{int(labels_val[i])}\n', f'{int(predicted)}\n',
-                      f'{probability[0]:.3f}\n', f'{probability[1]:.3f}\n']
-            for j in range(args.num_prototypes):
-                idx = j
-                nearest_proto = proto_texts[idx]
-                values.append(f'{nearest_proto}\n')
-                values.append(f'{idx + 1}\n')
-                values.append(f'{float(-prototype_distances[:, idx]):.3f}\n')
-                values.append(f'{float(-weights[idx, predicted]):.3f}\n')
-                values.append(f'{float(top_scores[j]):.3f}\n')
-            explained_test_samples.append(values)
+        for embedding, mask, text, labels in [(embedding_test, mask_test, text_test, labels_test),
+                                              (embedding_val, mask_val, text_val, labels_val)]:
+            # classify the whole set in batches instead of one forward pass per sample
+            distances, probabilities = [], []
+            for i in range(0, len(labels), args.batch_size):
+                prototype_distances, predicted_label = model.forward(embedding[i:i + args.batch_size],
+                                                                     mask[i:i + args.batch_size])
+                distances.append(prototype_distances.view(-1, args.num_prototypes).cpu())
+                probabilities.append(torch.nn.functional.softmax(predicted_label, dim=1).cpu())
+            distances, probabilities = torch.cat(distances).numpy(), torch.cat(probabilities).numpy()
+
+            for i in range(len(labels)):
+                predicted = int(np.argmax(probabilities[i]))
+                top_scores = distances[i] * weights[:, predicted]
+
+                values = [''.join(text[i]) + '\n', f'{int(labels[i])}\n', f'{predicted}\n',
+                          f'{probabilities[i, 0]:.3f}\n', f'{probabilities[i, 1]:.3f}\n']
+                for j in range(args.num_prototypes):
+                    idx = j
+                    nearest_proto = proto_texts[idx]
+                    values.append(f'{nearest_proto}\n')
+                    values.append(f'{idx + 1}\n')
+                    values.append(f'{float(-distances[i, idx]):.3f}\n')
+                    values.append(f'{float(-weights[idx, predicted]):.3f}\n')
+                    values.append(f'{float(top_scores[j]):.3f}\n')
+                explained_test_samples.append(values)
 
     import csv
     save_path = os.path.join(os.path.dirname(args.model_path), 'explained' + args.pid + '.csv')
@@ -713,7 +686,10 @@ if __name__ == '__main__':
     # torch.manual_seed(0)
     # np.random.seed(0)
     torch.set_num_threads(6)
+    setup_backends()
     args = parser.parse_args()
+    if args.accum_steps < 1:
+        parser.error('--accum_steps must be at least 1')
 
     rtpt = RTPT(name_initials='PK', experiment_name='Proto-Trex', max_iterations=args.num_epochs)
     rtpt.start()
@@ -725,7 +701,7 @@ if __name__ == '__main__':
     text_train, text_val, text_test, labels_train, labels_val, labels_test = load_data(args)
 
     # set class weights for balanced loss computation
-    args.class_weights = compute_class_weight(class_weight='balanced', classes=np.unique(labels_train), y=labels_train)
+    args.class_weights = get_class_weights(labels_train)
 
     if args.num_prototypes % args.num_classes:
         print('number of prototypes should be divisible by number of classes')
@@ -751,37 +727,32 @@ if __name__ == '__main__':
 
     fname = args.language_model
 
-    if not args.compute_emb:
-        embedding_train, mask_train = load_embedding(args, fname, 'train')
-        embedding_val, mask_val = load_embedding(args, fname, 'val')
-        embedding_test, mask_test = load_embedding(args, fname, 'test')
-    else:
-        embedding_train, mask_train = model.compute_embedding(text_train, args)
-        embedding_val, mask_val = model.compute_embedding(text_val, args)
-        embedding_test, mask_test = model.compute_embedding(text_test, args)
-        save_embedding(embedding_train, mask_train, args, fname, 'train')
-        save_embedding(embedding_val, mask_val, args, fname, 'val')
-        save_embedding(embedding_test, mask_test, args, fname, 'test')
-        torch.cuda.empty_cache()  # free up language model from GPU
+    embedding_train, mask_train = get_embedding(args, model, text_train, fname, 'train')
+    embedding_val, mask_val = get_embedding(args, model, text_val, fname, 'val')
+    embedding_test, mask_test = get_embedding(args, model, text_test, fname, 'test')
+    torch.cuda.empty_cache()  # free up language model from GPU
 
     if args.few_shot:
         idx = random.sample(range(len(text_train)), 100)
         text_train = list(text_train[i] for i in idx)
         labels_train = list(labels_train[i] for i in idx)
-        embedding_train = embedding_train[idx, :]
-        mask_train = mask_train[idx, :]
-
-    train_batches = torch.utils.data.DataLoader(list(zip(embedding_train, mask_train, labels_train)),
-                                                batch_size=args.batch_size, shuffle=True, pin_memory=True,
-                                                num_workers=0)
-    train_batches_unshuffled = torch.utils.data.DataLoader(list(zip(embedding_train, mask_train, labels_train)),
-                                                           batch_size=args.batch_size, shuffle=False, pin_memory=True,
-                                                           num_workers=0)
-    val_batches = torch.utils.data.DataLoader(list(zip(embedding_val, mask_val, labels_val)),
-                                              batch_size=args.batch_size, shuffle=False, pin_memory=True, num_workers=0)
-    test_batches = torch.utils.data.DataLoader(list(zip(embedding_test, mask_test, labels_test)),
-                                               batch_size=args.batch_size, shuffle=False, pin_memory=True,
-                                               num_workers=0)
+        # gather the rows with one index tensor, selection happens before the data is moved to the gpu
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        embedding_train = embedding_train.index_select(0, idx)
+        mask_train = mask_train.index_select(0, idx)
+
+    # keep the precomputed embeddings on the gpu for the whole run instead of copying every batch
+    device = f'cuda:{args.gpu[0]}'
+    embedding_train, mask_train = to_device(embedding_train, device), to_device(mask_train, device)
+    embedding_val, mask_val = to_device(embedding_val, device), to_device(mask_val, device)
+    embedding_test, mask_test = to_device(embedding_test, device), to_device(mask_test, device)
+
+    train_batches = TensorLoader(embedding_train, mask_train, labels_train, batch_size=args.batch_size, shuffle=True,
+                                 drop_last=True, device=device)
+    train_batches_unshuffled = TensorLoader(embedding_train, mask_train, labels_train, batch_size=args.batch_size,
+                                            device=device)
+    val_batches = TensorLoader(embedding_val, mask_val, labels_val, batch_size=args.batch_size, device=device)
+    test_batches = TensorLoader(embedding_test, mask_test, labels_test, batch_size=args.batch_size, device=device)
 
     time_stmp = datetime.datetime.now().strftime(f'%m-%d %H:%M:%S_{args.num_prototypes}_{fname}_{args.data_name}_{args.proto_size}_'
                                                  f'{args.attn}_{args.metric}_{args.pid}')
@@ -793,11 +764,16 @@ if __name__ == '__main__':
                       labels_train)
         model = remove_false(args, train_batches, val_batches, model, embedding_train, train_batches_unshuffled, text_train, labels_train)
     if not os.path.exists(args.model_path):
-        #load latest model path with given amount of prototypes if it exists
-        model_paths = glob.glob(f'./experiments/train_results/*_{fname}_{args.data_name}_*/*best_model.pth.tar')
-        model_paths.sort()
-        args.model_path = model_paths[-1]
-        checkpoint = torch.load(args.model_path)
+        # train() records its last checkpoint, only scan all training results if that record is missing
+        latest = f'./experiments/train_results/latest_{fname}_{args.data_name}.txt'
+        if os.path.isfile(latest):
+            with open(latest) as f:
+                args.model_path = f.read().strip()
+        if not os.path.exists(args.model_path):
+            #load latest model path with given amount of prototypes if it exists
+            args.model_path = max(glob.iglob(f'./experiments/train_results/*_{fname}_{args.data_name}_*/*best_model.pth.tar'),
+                                  key=os.path.getmtime)
+        checkpoint = torch.load(args.model_path, map_location=f'cuda:{args.gpu[0]}')
         model.load_state_dict(checkpoint['state_dict'])
     if 'test' in args.mode:
         test(args, embedding_train, mask_train, train_batches_unshuffled, test_batches, labels_train, text_train, model)
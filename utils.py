@@ -19,6 +19,7 @@ import clip
 from PIL import Image
 from tqdm import tqdm
 from sklearn.model_selection import train_test_split
+from sklearn.utils.class_weight import compute_class_weight
 import argparse
 
 
@@ -55,14 +56,100 @@ def update_params(args, model):
     return args, model
 
 
+def add_confusion(confusion, predicted, labels):
+    # add the counts of one batch to the confusion matrix in place, rows are true labels, columns predictions.
+    # unlike bincount, index_add_ does not read the value range back to the host, so there is no sync per batch
+    num_classes = confusion.size(0)
+    confusion.view(-1).index_add_(0, labels * num_classes + predicted, torch.ones_like(predicted))
+    return confusion
+
+
+def balanced_accuracy(confusion):
+    # mean recall over the classes occurring in the labels, same as sklearn's balanced_accuracy_score
+    support = confusion.sum(dim=1)
+    recall = confusion.diag()[support > 0].float() / support[support > 0]
+    return recall.mean().item()
+
+
+def get_amp_dtype():
+    # bf16 keeps the fp32 value range and needs no loss scaling, fall back to fp16 on older gpus
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+
+def setup_backends():
+    # let cudnn pick the fastest kernels for repeated shapes and allow tf32 tensor cores for fp32 matmuls
+    if torch.cuda.is_available():
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        if hasattr(torch, 'set_float32_matmul_precision'):
+            torch.set_float32_matmul_precision('high')
+
+
+def get_class_weights(labels):
+    # balanced class weights for the loss, kept as numpy so args stays printable and picklable
+    return compute_class_weight(class_weight='balanced', classes=np.unique(labels), y=labels)
+
+
+def class_weight_tensor(class_weights, device):
+    # the loss needs the weights as a float tensor on the gpu, args keeps the numpy values
+    return torch.as_tensor(class_weights, dtype=torch.float32, device=device)
+
+
+def to_device(t, device=None, pin_limit=2 ** 20):
+    # small host tensors (labels) are staged in pinned memory so the copy to the gpu runs asynchronously.
+    # bulk data is only copied without blocking if it already is pinned, pinning it here would need a
+    # second full host copy for a single transfer
+    t = torch.as_tensor(t)
+    if device is None:
+        return t
+    if torch.device(device).type == 'cuda' and not t.is_cuda:
+        if t.is_pinned():
+            return t.to(device, non_blocking=True)
+        if t.numel() <= pin_limit:
+            return t.pin_memory().to(device, non_blocking=True)
+    return t.to(device)
+
+
+class TensorLoader:
+    """Batch already stacked tensors by index instead of re-collating a list of samples every epoch."""
+
+    def __init__(self, *tensors, batch_size=1, shuffle=False, drop_last=False, device=None):
+        self.tensors = [to_device(t, device) for t in tensors]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def _stop(self):
+        n = self.tensors[0].size(0)
+        # drop the short last batch to keep shapes static, but never drop all data (e.g. few shot)
+        if self.drop_last and n >= self.batch_size:
+            return n - n % self.batch_size
+        return n
+
+    def __len__(self):
+        return -(-self._stop() // self.batch_size)
+
+    def __iter__(self):
+        n = self.tensors[0].size(0)
+        if self.shuffle:
+            # only draw a new permutation, the data itself stays where it is
+            perm = torch.randperm(n, device=self.tensors[0].device)
+            for i in range(0, self._stop(), self.batch_size):
+                idx = perm[i:i + self.batch_size]
+                yield [t[idx] for t in self.tensors]
+        else:
+            for i in range(0, self._stop(), self.batch_size):
+                yield [t[i:i + self.batch_size] for t in self.tensors]
+
+
 def extent_data(args, embedding_train, mask_train, text_train, labels_train, embedding, mask, text, label):
-    embedding_train = torch.cat((embedding_train, embedding.cpu().squeeze(0)))
-    mask_train = torch.cat((mask_train, mask.squeeze(0)))
+    embedding_train = torch.cat((embedding_train, embedding.to(embedding_train.device).squeeze(0)))
+    mask_train = torch.cat((mask_train, mask.to(mask_train.device).squeeze(0)))
     text_train.append(text)
     labels_train.append(int(label))
-    train_batches_unshuffled = torch.utils.data.DataLoader(list(zip(embedding_train, mask_train, labels_train)),
-                                                           batch_size=args.batch_size, shuffle=False, pin_memory=True,
-                                                           num_workers=0)
+    train_batches_unshuffled = TensorLoader(embedding_train, mask_train, labels_train, batch_size=args.batch_size,
+                                            device=embedding_train.device)
     return embedding_train, mask_train, text_train, labels_train, train_batches_unshuffled
 
 
@@ -70,9 +157,8 @@ def get_nearest(args, model, train_batches_unshuffled, text_train, labels_train)
     model.eval()
     dist, w = [], []
     with torch.no_grad():
+        # batches already live on the gpu, see TensorLoader
         for batch, mask, _ in train_batches_unshuffled:
-            batch = batch.to(f'cuda:{args.gpu[0]}')
-            mask = mask.to(f'cuda:{args.gpu[0]}')
             distances, top_w = model.get_dist(batch, mask)
             dist.append(distances)
             w.append(top_w)
@@ -155,31 +241,33 @@ def proto_loss(prototype_distances, label, model, args):
     # results = np.zeros((model_weights.shape))
     # results[min_indices, np.arange(model_weights.shape[1])] = 1
     # args.prototype_class_identity = torch.tensor(results).to(f'cuda:{args.gpu[0]}')
-    max_dist = torch.prod(torch.tensor(model.protolayer.size()))  # proxy variable, could be any high value
+    max_dist = model.protolayer.numel()  # proxy variable, could be any high value
 
     # prototypes_of_correct_class is tensor of shape  batch_size * num_prototypes
     # calculate cluster cost, high cost if same class protos are far distant
     prototypes_of_correct_class = torch.t(args.prototype_class_identity[:, label])
-    inverted_distances, _ = torch.max((max_dist - prototype_distances) * prototypes_of_correct_class, dim=1)
+    inverted_distances = ((max_dist - prototype_distances) * prototypes_of_correct_class).amax(dim=1)
     clust_loss = torch.mean(max_dist - inverted_distances)
     # assures that each sample is not too far distant form a prototype of its class
-    inverted_distances, _ = torch.max((max_dist - prototype_distances) * prototypes_of_correct_class, dim=0)
+    inverted_distances = ((max_dist - prototype_distances) * prototypes_of_correct_class).amax(dim=0)
     distr_loss = torch.mean(max_dist - inverted_distances)
 
     # calculate separation cost, low (highly negative) cost if other class protos are far distant
     prototypes_of_wrong_class = 1 - prototypes_of_correct_class
-    inverted_distances_to_nontarget_prototypes, _ = \
-        torch.max((max_dist - prototype_distances) * prototypes_of_wrong_class, dim=1)
+    inverted_distances_to_nontarget_prototypes = \
+        ((max_dist - prototype_distances) * prototypes_of_wrong_class).amax(dim=1)
     sep_loss = - torch.mean(max_dist - inverted_distances_to_nontarget_prototypes)
 
     # diversity loss, assures that prototypes are not too close
     # put penalty only onlyon prototypes of same class
-    comb = torch.combinations(torch.arange(0, args.num_prototypes), r=2)
+    # all pairs i < j, same order as torch.combinations but built directly on the device of the prototypes
+    comb = torch.triu_indices(args.num_prototypes, args.num_prototypes, offset=1, device=model.protolayer.device)
+    protos_i, protos_j = model.protolayer[:, comb[0]], model.protolayer[:, comb[1]]
     if args.metric == 'cosine':
-        divers_loss = torch.mean(F.cosine_similarity(model.protolayer[:, comb][:, :, 0],  model.protolayer[:, comb][:, :, 1]).squeeze()) #.clamp(min=0.8)
+        divers_loss = torch.mean(F.cosine_similarity(protos_i, protos_j).squeeze()) #.clamp(min=0.8)
 
     elif args.metric == 'L2':
-        divers_loss = torch.mean(nes_torch(model.protolayer[:, comb][:, :, 0], model.protolayer[:, comb][:, :, 1], dim=2).squeeze()) #.clamp(min=0.8)
+        divers_loss = torch.mean(nes_torch(protos_i, protos_j, dim=2).squeeze()) #.clamp(min=0.8)
 
     if args.soft:
         soft_loss = - torch.mean(F.cosine_similarity(model.protolayer[:, args.soft[1]], args.soft[4].squeeze(0),
@@ -196,6 +284,14 @@ def proto_loss(prototype_distances, label, model, args):
     return distr_loss, clust_loss, sep_loss, divers_loss, l1_loss
 
 
+@torch.jit.script
+def combined_loss(ce_loss, distr_loss, clust_loss, sep_loss, divers_loss, l1_loss,
+                  lambda1: float, lambda2: float, lambda3: float, lambda4: float, lambda5: float):
+    # weighted sum of all losses, scripted so the elementwise ops can be fused into one kernel
+    return ce_loss + lambda1 * distr_loss + lambda2 * clust_loss + lambda3 * sep_loss + lambda4 * divers_loss + \
+        lambda5 * l1_loss
+
+
 def project(args, embedding_train, model, train_batches_unshuffled, text_train, labels_train):
     # project prototypes
     if args.level == 'sentence':
@@ -931,6 +1027,21 @@ def save_embedding(embedding, mask, args, fname, set_name):
     torch.save(mask, path_m)
 
 
+def get_embedding(args, model, text, fname, set_name):
+    # only run the language model if the embedding is not stored yet or a recomputation is requested
+    path = os.path.join('data/embedding', args.data_name)
+    name = fname + '_' + set_name
+    if not args.compute_emb and os.path.isfile(os.path.join(path, name + '.pt')) and \
+            os.path.isfile(os.path.join(path, name + '_mask.pt')):
+        embedding, mask = load_embedding(args, fname, set_name)
+        # a stored embedding of a differently sized split (e.g. other preprocessing) is stale
+        if embedding.size(0) == len(text):
+            return embedding, mask
+    embedding, mask = model.compute_embedding(text, args)
+    save_embedding(embedding, mask, args, fname, set_name)
+    return embedding, mask
+
+
 #############################################################
 #############################################################
 #############################################################